@@ -1,22 +1,52 @@
+import os
+# Tesseract's OpenMP threading only adds overhead on small images
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 import cv2
-import pytesseract
+import tesserocr
 import asyncio
 import websockets
-import json
+import orjson
+import xxhash
 import threading
+import queue
 import time
 import re
-from datetime import datetime
 import numpy as np
 
 class NumberDetector:
-    def __init__(self, port=8000):
+    # Numbers (including decimals) in OCR output
+    _NUM_RE = re.compile(r'\d+\.?\d*')
+    # Characters Tesseract is allowed to recognise
+    _OCR_WHITELIST = "0123456789."
+    
+    def __init__(self, port=8000, show_window=False):
         self.port = port
+        self.show_window = show_window  # Show a preview window (needs a display)
         self.cap = None
         self.running = False
+        self.stop_event = threading.Event()  # Set once to shut detection down
         self.last_number = None
         self.confidence_threshold = 50
+        self.min_contrast = 15.0  # Grayscale std dev below which a frame has no digits
+        self.ocr_width = 320  # Max frame width handed to OCR (aspect ratio kept)
         self.connected_clients = set()
+        self.loop = None
+        
+        # Preprocessing kernel and scratch buffers, reused across frames
+        self._morph_kernel = np.ones((2, 2), np.uint8)
+        self._gray = None
+        self._blur = None
+        self._thresh = None
+        self._clean = None
+        
+        # Hash of the last OCR'd preprocessed frame and what it yielded
+        self._last_hash = None
+        self._last_numbers = []
+        
+        # Persistent in-process Tesseract handle (no subprocess per frame)
+        self.api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.DEFAULT)
+        self.api.SetVariable("tessedit_char_whitelist", self._OCR_WHITELIST)
         
     async def register_client(self, websocket):
         """Register a new WebSocket client"""
@@ -34,21 +64,27 @@ class NumberDetector:
             data = {
                 "type": "number_detected",
                 "number": number,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": time.time_ns() // 1_000_000  # Epoch milliseconds
             }
-            message = json.dumps(data)
+            # Send as a text frame; the GUI parses event.data as a string
+            try:
+                message = orjson.dumps(data).decode()
+            except orjson.JSONEncodeError as e:
+                # e.g. OCR noise parsed into an int wider than 64 bits
+                print(f"Encode error: {e}")
+                return
             
-            # Send to all connected clients
-            disconnected = set()
-            for client in self.connected_clients:
-                try:
-                    await client.send(message)
-                except websockets.exceptions.ConnectionClosed:
-                    disconnected.add(client)
+            # Send to all connected clients concurrently
+            clients = list(self.connected_clients)
+            sends = [client.send(message) for client in clients]
+            results = await asyncio.gather(*sends, return_exceptions=True)
             
             # Remove disconnected clients
-            for client in disconnected:
-                self.connected_clients.discard(client)
+            for client, result in zip(clients, results):
+                if isinstance(result, websockets.exceptions.ConnectionClosed):
+                    self.connected_clients.discard(client)
+                elif isinstance(result, Exception):
+                    print(f"Send error: {result}")
             
             print(f"Broadcasted number {number} to {len(self.connected_clients)} clients")
         
@@ -66,78 +102,104 @@ class NumberDetector:
     
     def send_number_sync(self, number):
         """Synchronous wrapper to send number from detection thread"""
-        if self.connected_clients:
-            # Use thread-safe way to schedule coroutine
-            def run_broadcast():
-                try:
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    loop.run_until_complete(self.broadcast_number(number))
-                finally:
-                    loop.close()
+        if self.connected_clients and self.loop:
+            # Schedule the broadcast on the server's event loop
+            future = asyncio.run_coroutine_threadsafe(self.broadcast_number(number), self.loop)
+            
+            def report_failure(fut):
+                if fut.cancelled():
+                    return
+                e = fut.exception()
+                if e is not None:
+                    print(f"Broadcast error: {e}")
+                    # Allow the detection loop to send this number again
+                    if self.last_number == number:
+                        self.last_number = None
             
-            # Run in a separate thread to avoid blocking
-            broadcast_thread = threading.Thread(target=run_broadcast)
-            broadcast_thread.daemon = True
-            broadcast_thread.start()
+            future.add_done_callback(report_failure)
     
-    def preprocess_image(self, image):
-        """Preprocess image for better OCR results"""
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    def preprocess_image(self, gray):
+        """Preprocess grayscale image for better OCR results"""
+        # (Re)allocate scratch buffers when the frame size changes
+        if self._blur is None or self._blur.shape != gray.shape:
+            self._blur = np.empty(gray.shape, np.uint8)
+            self._thresh = np.empty(gray.shape, np.uint8)
+            self._clean = np.empty(gray.shape, np.uint8)
         
-        # Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        # Apply box blur to reduce noise
+        blurred = cv2.boxFilter(gray, -1, (5, 5), dst=self._blur)
         
-        # Apply adaptive threshold
+        # Apply adaptive threshold against the local mean (box filter, O(1) per pixel)
         thresh = cv2.adaptiveThreshold(
-            blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 11, 2
+            blurred, 255, cv2.ADAPTIVE_THRESH_MEAN_C, 
+            cv2.THRESH_BINARY, 11, 2, dst=self._thresh
         )
         
         # Morphological operations to clean up
-        kernel = np.ones((2, 2), np.uint8)
-        cleaned = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
+        cleaned = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, self._morph_kernel, dst=self._clean)
         
         return cleaned
     
     def extract_numbers(self, image):
         """Extract numbers from image using OCR"""
         try:
+            # Convert to grayscale
+            shape = image.shape[:2]
+            if self._gray is None or self._gray.shape != shape:
+                self._gray = np.empty(shape, np.uint8)
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._gray)
+            
+            # Textureless frames (kart out of view) cannot contain digits
+            _, std = cv2.meanStdDev(gray)
+            if std[0, 0] < self.min_contrast:
+                return []
+            
             # Preprocess the image
-            processed = self.preprocess_image(image)
+            processed = self.preprocess_image(gray)
             
-            # OCR configuration for better number detection
-            config = '--oem 3 --psm 6 -c tessedit_char_whitelist=0123456789.'
+            # Skip OCR when the binarized frame is unchanged since last time
+            frame_hash = xxhash.xxh3_64_intdigest(processed)
+            if frame_hash == self._last_hash:
+                return self._last_numbers
             
-            # Extract text with confidence scores
-            data = pytesseract.image_to_data(processed, config=config, output_type=pytesseract.Output.DICT)
+            # Extract text and the page-level confidence
+            height, width = processed.shape
+            self.api.SetImageBytes(processed.tobytes(), width, height, 1, width)
+            text = self.api.GetUTF8Text()
             
             numbers = []
-            for i in range(len(data['text'])):
-                text = data['text'][i].strip()
-                conf = int(data['conf'][i])
-                
-                if text and conf > self.confidence_threshold:
-                    # Use regex to find numbers (including decimals)
-                    number_matches = re.findall(r'\d+\.?\d*', text)
-                    for match in number_matches:
-                        try:
-                            # Convert to float if it contains decimal, otherwise int
-                            if '.' in match:
-                                num = float(match)
-                            else:
-                                num = int(match)
-                            numbers.append(num)
-                        except ValueError:
-                            continue
+            if self.api.MeanTextConf() > self.confidence_threshold:
+                # Convert to float if it contains decimal, otherwise int
+                numbers = [float(match) if '.' in match else int(match)
+                           for match in self._NUM_RE.findall(text)]
             
+            self._last_hash = frame_hash
+            self._last_numbers = numbers
             return numbers
             
         except Exception as e:
             print(f"OCR error: {e}")
             return []
     
+    def capture_frames(self, frames):
+        """Grab camera frames, keeping only the most recent one in the queue"""
+        while self.running and not self.stop_event.is_set():
+            ret, frame = self.cap.read()
+            if not ret:
+                print("Failed to grab frame")
+                self.running = False
+                break
+            
+            # Replace any frame the OCR loop has not picked up yet
+            try:
+                frames.put_nowait(frame)
+            except queue.Full:
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    pass
+                frames.put_nowait(frame)
+    
     def start_detection(self):
         """Start the number detection process"""
         print("Starting number detection...")
@@ -146,47 +208,66 @@ class NumberDetector:
         self.cap = cv2.VideoCapture(0)
         if not self.cap.isOpened():
             print("Error: Could not open camera")
+            self.cleanup()
             return
         
-        # Set camera properties
+        # Set camera properties (MJPG keeps USB transfer and decode cheap)
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
         
+        # Only capture as many frames as we run OCR on
+        self.cap.set(cv2.CAP_PROP_FPS, 6)
+        
         self.running = True
-        frame_count = 0
+        
+        # Capture on its own thread so OCR always sees the freshest frame
+        frames = queue.Queue(maxsize=1)
+        capture_thread = threading.Thread(target=self.capture_frames, args=(frames,))
+        capture_thread.daemon = True
+        capture_thread.start()
         
         try:
-            while self.running:
-                ret, frame = self.cap.read()
-                if not ret:
-                    print("Failed to grab frame")
-                    break
-                
-                # Process every 5th frame to reduce CPU usage
-                if frame_count % 5 == 0:
-                    numbers = self.extract_numbers(frame)
-                    
-                    if numbers:
-                        # Send the first detected number
-                        current_number = numbers[0]
-                        
-                        # Only send if it's different from the last number
-                        if current_number != self.last_number:
-                            self.send_number_sync(current_number)
-                            self.last_number = current_number
+            while self.running and not self.stop_event.is_set():
+                try:
+                    frame = frames.get(timeout=1)
+                except queue.Empty:
+                    continue
                 
-                # Display the frame (optional, comment out for headless operation)
-                cv2.imshow('Number Detection', frame)
+                # Downscale before OCR; Tesseract cost scales with pixel count
+                scale = self.ocr_width / frame.shape[1]
+                if scale < 1:
+                    small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                else:
+                    small = frame
+                numbers = self.extract_numbers(small)
                 
-                # Break on 'q' key press
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
+                if numbers:
+                    # Send the first detected number
+                    current_number = numbers[0]
+                    
+                    # Only send if it's different from the last number
+                    if current_number != self.last_number:
+                        self.send_number_sync(current_number)
+                        self.last_number = current_number
                 
-                frame_count += 1
+                # Display the frame; headless runs stop via stop_event instead
+                if self.show_window:
+                    cv2.imshow('Number Detection', frame)
+                    
+                    # Break on 'q' key press
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        break
                 
         except KeyboardInterrupt:
             print("Detection stopped by user")
         finally:
+            self.running = False
+            capture_thread.join(timeout=2)
+            if capture_thread.is_alive():
+                # Still blocked in cap.read(); releasing the camera under it could crash
+                print("Capture thread did not stop; leaving camera open")
+                self.cap = None
             self.cleanup()
     
     async def start_websocket_server(self):
@@ -196,11 +277,15 @@ class NumberDetector:
             await asyncio.Future()  # Run forever
     
     def cleanup(self):
-        """Clean up resources"""
+        """Clean up resources (called from the detection thread once it stops)"""
         self.running = False
         if self.cap:
             self.cap.release()
-        cv2.destroyAllWindows()
+        if self.api:
+            self.api.End()
+            self.api = None
+        if self.show_window:
+            cv2.destroyAllWindows()
         print("Cleanup completed")
 
 async def main():
@@ -208,6 +293,7 @@ async def main():
     PORT = 8000  # WebSocket server port
     
     detector = NumberDetector(PORT)
+    detector.loop = asyncio.get_running_loop()
     
     # Start WebSocket server in background
     server_task = asyncio.create_task(detector.start_websocket_server())
@@ -223,7 +309,9 @@ async def main():
     except KeyboardInterrupt:
         print("Server stopped by user")
     finally:
-        detector.cleanup()
+        # Stop detection; the detection thread releases its own resources
+        detector.stop_event.set()
+        detection_thread.join(timeout=5)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file